@@ -1,11 +1,18 @@
 import os
 import io
+import asyncio
 import logging
+import sqlite3
 import datetime
 import re
+import time
 import textwrap
+from collections import deque
+from functools import lru_cache
+from itertools import chain, zip_longest
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-import pytz
+import orjson
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -19,77 +26,158 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     filters,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     PicklePersistence,
 )
 
 # --- Environment and Configuration ---
-load_dotenv()
-TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
-    raise RuntimeError("❌ BOT_TOKEN not set in environment")
-
-# Logging configuration
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+# The token and logging are set up in main(), so importing this module has no side effects.
 logger = logging.getLogger(__name__)
 
 # --- Constants ---
 VERSION = "2.4"
-PERSISTENCE_FILE = "brain_vault_persistence.pkl"
-ADELAIDE_TZ = pytz.timezone("Australia/Adelaide")
+PERSISTENCE_FILE = "brain_vault.sqlite3"
+LEGACY_PERSISTENCE_FILE = "brain_vault_persistence.pkl"
+PERSISTENCE_INTERVAL = 30  # seconds between persistence writes
+MAX_CONCURRENT_UPDATES = 256
+CONNECTION_POOL_SIZE = 64  # concurrent requests to the Bot API
+POOL_TIMEOUT = 30  # seconds to wait for a free connection
+ADELAIDE_TZ = ZoneInfo("Australia/Adelaide")
+HASHTAG_RE = re.compile(r'#[\w-]+')
+DELNOTE_RE = re.compile(r'#([\w-]+)\s+(\d+)')
+FILENAME_TRANS = str.maketrans(" :", "_-")
 
 # --- Helper Functions ---
 
+_timestamp_cache = [0, ""]  # [epoch second, formatted timestamp]
+
 def get_current_timestamp() -> str:
-    """Returns the current timestamp formatted for Adelaide time."""
-    now_utc = datetime.datetime.now(datetime.timezone.utc)
-    adl_time = now_utc.astimezone(ADELAIDE_TZ)
-    return adl_time.strftime("%Y-%m-%d %I:%M:%S %p")
+    """Returns the current timestamp formatted for Adelaide time, reformatting at most once per second."""
+    now = int(time.time())
+    if now != _timestamp_cache[0]:
+        t = datetime.datetime.fromtimestamp(now, ADELAIDE_TZ)
+        _timestamp_cache[:] = [now, (
+            f"{t.year:04d}-{t.month:02d}-{t.day:02d} "
+            f"{(t.hour - 1) % 12 + 1:02d}:{t.minute:02d}:{t.second:02d} "
+            f"{'AM' if t.hour < 12 else 'PM'}"
+        )]
+    return _timestamp_cache[1]
+
+def migrate_legacy_notes(user_data: dict) -> None:
+    """Converts category lists of 'text @ timestamp' strings into the id-based note store."""
+    legacy = user_data.get('notes', {})
+    notes, entries, ids_by_line = {}, {}, {}
+    for cat in sorted(legacy, key=lambda c: c != 'all'):
+        notes[cat] = []
+        for line in legacy[cat]:
+            note_id = next((i for i in ids_by_line.get(line, []) if cat not in entries[i]['cats']), None)
+            if note_id is None:
+                note_id = len(entries) + 1
+                text, _, timestamp = line.rpartition(' @ ')
+                entries[note_id] = {'id': note_id, 'text': text, 'ts': timestamp, 'cats': set()}
+                ids_by_line.setdefault(line, []).append(note_id)
+            entries[note_id]['cats'].add(cat)
+            notes[cat].append(note_id)
+    user_data['notes'] = notes
+    user_data['entries'] = entries
+    user_data['next_note_id'] = len(entries) + 1
 
 def get_notes(context: ContextTypes.DEFAULT_TYPE) -> dict:
-    """Safely retrieves the notes dictionary from user_data, initializing if needed."""
-    notes = context.user_data.setdefault('notes', {})
+    """Safely retrieves the category -> note ids dictionary from user_data, initializing if needed."""
+    if 'entries' not in context.user_data:
+        migrate_legacy_notes(context.user_data)
+    notes = context.user_data['notes']
     notes.setdefault('all', [])
     return notes
 
-def extract_hashtags(text: str) -> list[str]:
-    """Extracts unique, lowercase hashtags from a string."""
-    return sorted(list(set(tag.lstrip('#').lower() for tag in re.findall(r'#[\w-]+', text))))
+def get_entries(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """Retrieves the note id -> entry dictionary from user_data."""
+    get_notes(context)
+    return context.user_data['entries']
 
-def get_category_keyboard(notes: dict, selected_cats: set) -> InlineKeyboardMarkup | None:
-    """Generates the category selection keyboard."""
-    buttons = []
-    all_categories = sorted([cat for cat in notes if cat != 'all'])
-    if not all_categories:
-        return None
-    row = []
-    for cat in all_categories:
-        prefix = "✅ " if cat in selected_cats else ""
-        count = len(notes.get(cat, []))
-        button = InlineKeyboardButton(f"{prefix}#{cat} ({count})", callback_data=f"cat_{cat}")
-        row.append(button)
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
+def format_entry(entry: dict) -> str:
+    """Renders a note entry as 'text @ timestamp'."""
+    return f"{entry['text']} @ {entry['ts']}"
+
+def find_hashtags(text: str) -> list[str]:
+    """Returns the raw '#tag' tokens of a string in order of appearance."""
+    if '#' not in text:
+        return []
+    return HASHTAG_RE.findall(text)
+
+def normalize_hashtags(raw_tags: list[str]) -> list[str]:
+    """Turns raw '#tag' tokens into unique, lowercase, sorted category names."""
+    return sorted({tag[1:].lower() for tag in raw_tags})
+
+def numbered_note_lines(note_ids: list[int], entries: dict):
+    """Yields the '<code>N.</code> note' lines used by /view."""
+    for idx, note_id in enumerate(note_ids, 1):
+        yield f"<code>{idx}.</code> {format_entry(entries[note_id])}"
+
+def chunk_lines(lines, limit: int = 4000):
+    """Yields newline-joined chunks of at most `limit` characters, splitting only between lines."""
+    buf, size = [], 0
+    for line in lines:
+        if buf and size + 1 + len(line) > limit:
+            chunk = "\n".join(buf)
+            if chunk.strip():
+                yield chunk
+            buf, size = [], 0
+        if len(line) > limit:
+            # A single line longer than the limit has no boundary to split on.
+            for i in range(0, len(line), limit):
+                yield line[i:i + limit]
+            continue
+        size += len(line) + (1 if buf else 0)
+        buf.append(line)
+    chunk = "\n".join(buf)
+    if chunk.strip():
+        yield chunk
+
+@lru_cache(maxsize=256)
+def build_category_keyboard(cats_counts: tuple, selected_cats: frozenset) -> InlineKeyboardMarkup:
+    """Builds the category selection keyboard from (category, note count) pairs; buttons carry the pair's index."""
+    btns = [
+        InlineKeyboardButton(f"{'✅ ' if cat in selected_cats else ''}#{cat} ({count})", callback_data=f"c{idx}")
+        for idx, (cat, count) in enumerate(cats_counts)
+    ]
+    buttons = [[a, b] if b is not None else [a] for a, b in zip_longest(btns[0::2], btns[1::2])]
     buttons.append([InlineKeyboardButton("Done ✅", callback_data="cat_done")])
     return InlineKeyboardMarkup(buttons)
 
+def get_category_order(notes: dict) -> list[str]:
+    """Returns the categories offered on the selection keyboard, in button order."""
+    return [cat for cat in sorted(notes) if cat != 'all']
+
+def get_category_keyboard(notes: dict, category_order: list[str], selected_cats: set) -> InlineKeyboardMarkup | None:
+    """Generates the category selection keyboard for the given category order."""
+    if not category_order:
+        return None
+    cats_counts = tuple((cat, len(notes[cat])) for cat in category_order)
+    return build_category_keyboard(cats_counts, frozenset(selected_cats))
+
+def get_keyboard_orders(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """Returns the message id -> category order map for the open category keyboard."""
+    orders = context.user_data.get('category_order')
+    if not isinstance(orders, dict):
+        orders = context.user_data['category_order'] = {}
+    return orders
+
 async def save_note(context: ContextTypes.DEFAULT_TYPE, note_text: str, categories: set) -> str:
     """Saves a note to the specified categories and returns a confirmation message."""
     notes = get_notes(context)
+    entries = context.user_data['entries']
+    note_id = context.user_data['next_note_id']
+    context.user_data['next_note_id'] = note_id + 1
     timestamp = context.user_data.pop('pending_note_ts', get_current_timestamp())
-    entry = f"{note_text} @ {timestamp}"
-    notes['all'].append(entry)
-    saved_to = {'#all'}
-    for cat in categories:
-        if cat != 'all':
-            notes.setdefault(cat, []).append(entry)
-            saved_to.add(f'#{cat}')
-    return f"✅ Note saved to: {', '.join(sorted(list(saved_to)))}\n📝 {entry}"
+    entry = {'id': note_id, 'text': note_text, 'ts': timestamp, 'cats': set(categories) | {'all'}}
+    entries[note_id] = entry
+    for cat in entry['cats']:
+        notes.setdefault(cat, []).append(note_id)
+    saved_to = sorted(f'#{cat}' for cat in entry['cats'])
+    return f"✅ Note saved to: {', '.join(saved_to)}\n📝 {format_entry(entry)}"
 
 # --- Command Handlers ---
 
@@ -124,66 +212,59 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Displays notes, either all or from a specific category."""
     notes = get_notes(context)
+    entries = get_entries(context)
     args = context.args
 
     if args:
         cat_name = args[0].lstrip('#').lower()
-        entries = notes.get(cat_name)
-        if not entries:
+        note_ids = notes.get(cat_name)
+        if not note_ids:
             await update.message.reply_text(
                 f"⚠️ No entries found for <code>#{cat_name}</code>.",
                 parse_mode=ParseMode.HTML
             )
             return
-        header = f"<b>📝 Notes in #{cat_name} ({len(entries)})</b>"
-        note_lines = [f"<code>{idx}.</code> {entry}" for idx, entry in enumerate(entries, 1)]
-        message_lines = [header, ""] + note_lines
+        header = f"<b>📝 Notes in #{cat_name} ({len(note_ids)})</b>"
+        message_lines = chain((header, ""), numbered_note_lines(note_ids, entries))
     else:
         total_unique_notes = len(notes.get('all', []))
         if total_unique_notes == 0:
             await update.message.reply_text("📭 Your brain vault is empty. Start by typing a note!")
             return
         header = f"📚 <b>All Notes ({total_unique_notes} total)</b>"
-        message_lines = [header, ""]
-        sorted_cats = sorted([cat for cat in notes if notes[cat]])
-        if 'all' in sorted_cats:
-            sorted_cats.insert(0, sorted_cats.pop(sorted_cats.index('all')))
-        for cat_name in sorted_cats:
-            entries = notes[cat_name]
-            message_lines.append(f"\n<b>📑 #{cat_name} ({len(entries)})</b>")
-            message_lines.extend([f"<code>{idx}.</code> {entry}" for idx, entry in enumerate(entries, 1)])
-            message_lines.append("")
-    message = "\n".join(message_lines)
-    if len(message) > 4000:
-        for i in range(0, len(message), 4000):
-            await update.message.reply_text(message[i:i + 4000], parse_mode=ParseMode.HTML)
-    else:
-        await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+        sorted_cats = ['all'] + sorted(cat for cat in notes if cat != 'all' and notes[cat])
+        message_lines = chain((header, ""), chain.from_iterable(
+            (f"\n<b>📑 #{cat_name} ({len(notes[cat_name])})</b>", *numbered_note_lines(notes[cat_name], entries), "")
+            for cat_name in sorted_cats
+        ))
+    for chunk in chunk_lines(message_lines):
+        await update.message.reply_text(chunk, parse_mode=ParseMode.HTML)
 
 async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Exports all notes to a text file."""
     notes = get_notes(context)
+    entries = get_entries(context)
     if not notes.get('all'):
         await update.message.reply_text("📭 Nothing to export. Your vault is empty.")
         return
-    timestamp_str = get_current_timestamp().replace(" ", "_").replace(":", "-")
+    timestamp_str = get_current_timestamp().translate(FILENAME_TRANS)
     filename = f"brain_vault_notes_{timestamp_str}.txt"
-    lines = [
-        "🧠━━━━━━━━━━━━━━━━━━━━━━━━━━━━━🧠",
-        "   BRAIN VAULT - THE MOCKINGJAY",
-        "🧠━━━━━━━━━━━━━━━━━━━━━━━━━━━━━🧠",
-        f"Generated: {get_current_timestamp()}",
-        ""
-    ]
-    sorted_cats = sorted([cat for cat in notes if notes[cat]])
-    if 'all' in sorted_cats:
-        sorted_cats.insert(0, sorted_cats.pop(sorted_cats.index('all')))
+    header = (
+        "🧠━━━━━━━━━━━━━━━━━━━━━━━━━━━━━🧠\n"
+        "   BRAIN VAULT - THE MOCKINGJAY\n"
+        "🧠━━━━━━━━━━━━━━━━━━━━━━━━━━━━━🧠\n"
+        f"Generated: {get_current_timestamp()}\n"
+        "\n"
+    )
+    buf = bytearray(header.encode('utf-8'))
+    sorted_cats = ['all'] + sorted(cat for cat in notes if cat != 'all' and notes[cat])
     for cat in sorted_cats:
-        lines.append(f"\n# {cat}")
-        lines.extend(notes[cat])
-        lines.append("")
-    file_content = "\n".join(lines).encode('utf-8')
-    bio = io.BytesIO(file_content)
+        buf += f"\n# {cat}\n".encode('utf-8')
+        for note_id in notes[cat]:
+            buf += format_entry(entries[note_id]).encode('utf-8')
+            buf += b'\n'
+        buf += b'\n'
+    bio = io.BytesIO(buf)
     bio.name = filename
     bio.seek(0)
     await update.message.reply_document(
@@ -210,8 +291,10 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if awaiting_action:
         await handle_edit_input(update, context, awaiting_action, text)
         return
-    hashtags = extract_hashtags(text)
-    if text.replace(" ", "") == "".join(f"#{tag}" for tag in hashtags):
+    raw_tags = find_hashtags(text)
+    hashtags = normalize_hashtags(raw_tags)
+    # Tag tokens never contain spaces, so the message is tags-only when they cover every other character.
+    if len(text) - text.count(' ') - text.count('\t') == sum(len(tag) for tag in raw_tags):
         new_cats = []
         for tag in hashtags:
             if tag not in notes:
@@ -225,40 +308,57 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     context.user_data['pending_note'] = text
     context.user_data['pending_note_ts'] = get_current_timestamp()
     context.user_data['selected_categories'] = set(hashtags)
-    keyboard = get_category_keyboard(notes, set(hashtags))
+    # A new pending note makes every earlier category keyboard stale.
+    context.user_data['category_order'] = {}
+    category_order = get_category_order(notes)
+    keyboard = get_category_keyboard(notes, category_order, set(hashtags))
     if keyboard:
         msg = "Select additional categories for your note:"
         if hashtags:
             msg += f"\n(Auto-selected from text: {', '.join(f'#{t}' for t in hashtags)})"
-        await update.message.reply_text(msg, reply_markup=keyboard)
+        sent = await update.message.reply_text(msg, reply_markup=keyboard)
+        get_keyboard_orders(context)[sent.message_id] = category_order
     else:
-        confirmation_message = await save_note(context, text, set(hashtags))
-        await update.message.reply_text(confirmation_message)
         context.user_data.pop('pending_note', None)
         context.user_data.pop('selected_categories', None)
+        confirmation_message = await save_note(context, text, set(hashtags))
+        await update.message.reply_text(confirmation_message)
 
 async def category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles button presses from the category selection keyboard."""
     query = update.callback_query
-    await query.answer()
     data = query.data
-    notes = get_notes(context)
-    selected_cats = context.user_data.setdefault('selected_categories', set())
+    orders = get_keyboard_orders(context)
+    message_id = query.message.message_id if query.message else None
+    category_order = orders.get(message_id)
+    legacy_button = data.startswith('cat_') and data != 'cat_done'
+    if category_order is None or legacy_button:
+        # Keyboard of an earlier or already saved note, or a pre-index 'cat_<name>' button.
+        await query.answer("⌛ This menu has expired. Please send your note again.")
+        return
     if data == 'cat_done':
         note_text = context.user_data.pop('pending_note', None)
+        selected_cats = context.user_data.pop('selected_categories', set())
+        context.user_data.pop('category_order', None)
         if not note_text:
+            await query.answer()
             await query.edit_message_text("❌ Error: No pending note found. Please try again.")
             return
         confirmation_message = await save_note(context, note_text, selected_cats)
+        await query.answer()
         await query.edit_message_text(confirmation_message)
-        context.user_data.pop('selected_categories', None)
     else:
-        cat_name = data.removeprefix('cat_')
+        selected_cats = context.user_data.setdefault('selected_categories', set())
+        # The order is the one this message's buttons were rendered with, so the index matches the label.
+        cat_name = category_order[int(data[1:])]
         if cat_name in selected_cats:
             selected_cats.remove(cat_name)
         else:
             selected_cats.add(cat_name)
-        keyboard = get_category_keyboard(notes, selected_cats)
+        notes = get_notes(context)
+        orders[message_id] = get_category_order(notes)
+        keyboard = get_category_keyboard(notes, orders[message_id], selected_cats)
+        await query.answer()
         await query.edit_message_reply_markup(reply_markup=keyboard)
 
 async def edit_option_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -279,17 +379,19 @@ async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Processes the text input after an edit option was chosen."""
     context.user_data.pop('awaiting_action')
     notes = get_notes(context)
+    entries = get_entries(context)
     if action == 'edit_delcat':
         cat_to_delete = text.lstrip('#').lower()
         if cat_to_delete == 'all':
             await update.message.reply_text("⚠️ The <code>#all</code> category cannot be deleted.", parse_mode=ParseMode.HTML)
         elif cat_to_delete in notes:
-            del notes[cat_to_delete]
+            for note_id in notes.pop(cat_to_delete):
+                entries[note_id]['cats'].discard(cat_to_delete)
             await update.message.reply_text(f"✅ Category <code>#{cat_to_delete}</code> has been deleted.", parse_mode=ParseMode.HTML)
         else:
             await update.message.reply_text(f"❌ Category <code>#{cat_to_delete}</code> not found.", parse_mode=ParseMode.HTML)
     elif action == 'edit_delnote':
-        match = re.match(r'#([\w-]+)\s+(\d+)', text.strip())
+        match = DELNOTE_RE.match(text.strip())
         if not match:
             await update.message.reply_text("⚠️ Invalid format. Please use: <code>#category number</code> (e.g., #work 2).", parse_mode=ParseMode.HTML)
             return
@@ -299,23 +401,259 @@ async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
         if cat_name not in notes or not (0 <= note_idx < len(notes[cat_name])):
             await update.message.reply_text(f"❌ Note <code>#{cat_name} {note_num_str}</code> not found.", parse_mode=ParseMode.HTML)
             return
-        deleted_note_entry = notes[cat_name].pop(note_idx)
-        if deleted_note_entry in notes.get('all', []):
-            notes['all'].remove(deleted_note_entry)
-        await update.message.reply_text(f"✅ Deleted note from <code>#{cat_name}</code>:\n<s>{deleted_note_entry}</s>", parse_mode=ParseMode.HTML)
+        deleted_entry = entries.pop(notes[cat_name].pop(note_idx))
+        # Still linear in each category's length: the other categories are searched for the id.
+        for cat in deleted_entry['cats'] - {cat_name}:
+            notes[cat].remove(deleted_entry['id'])
+        await update.message.reply_text(f"✅ Deleted note from <code>#{cat_name}</code>:\n<s>{format_entry(deleted_entry)}</s>", parse_mode=ParseMode.HTML)
+
+# --- Persistence ---
+
+def encode_user_data(data: dict) -> bytes:
+    """Serializes user_data to JSON; sets become lists and int keys become strings."""
+    return orjson.dumps(data, default=list, option=orjson.OPT_NON_STR_KEYS)
+
+def decode_user_data(raw: bytes) -> dict:
+    """Restores user_data from JSON, including the int note ids and the set-valued fields."""
+    data = orjson.loads(raw)
+    if 'entries' in data:
+        data['entries'] = {int(note_id): {**entry, 'cats': set(entry['cats'])} for note_id, entry in data['entries'].items()}
+    if 'selected_categories' in data:
+        data['selected_categories'] = set(data['selected_categories'])
+    if isinstance(data.get('category_order'), dict):
+        data['category_order'] = {int(message_id): order for message_id, order in data['category_order'].items()}
+    return data
+
+class SqlitePersistence(BasePersistence[dict, dict, dict]):
+    """Stores each user's data as its own row in a SQLite database, so saving one user never rewrites the others."""
+
+    def __init__(self, filepath: str, legacy_filepath: str | None = None, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.filepath = filepath
+        self.legacy_filepath = legacy_filepath
+        self._conn: sqlite3.Connection | None = None
+        self._pending: dict[int, dict | None] = {}  # user_id -> data to write, or None to delete
+        self._write_task: asyncio.Task | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Writes happen in a worker thread (see _write_pending), reads on the event loop at startup.
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)"
+            )
+        return self._conn
+
+    def _write_user_data(self, user_id: int, data: dict) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+            (user_id, encode_user_data(data)),
+        )
+
+    def _encode_batch(self, batch: dict[int, dict | None]) -> dict[int, bytes | None]:
+        """Encodes staged user_data, logging and skipping users whose data cannot be serialized."""
+        encoded = {}
+        for user_id, data in batch.items():
+            if data is None:
+                encoded[user_id] = None
+                continue
+            try:
+                encoded[user_id] = encode_user_data(data)
+            except TypeError:
+                logger.exception(f"❌ Skipping user {user_id}: user_data is not serializable")
+        return encoded
+
+    async def _import_legacy_pickle(self) -> dict[int, dict]:
+        """One-time import of user data from a PicklePersistence file."""
+        user_data = await PicklePersistence(filepath=self.legacy_filepath).get_user_data()
+        with self.conn:
+            for user_id, data in user_data.items():
+                self._write_user_data(user_id, data)
+        logger.info(f"📦 Imported {len(user_data)} users from {self.legacy_filepath}")
+        return dict(user_data)
+
+    async def get_user_data(self) -> dict[int, dict]:
+        rows = self.conn.execute("SELECT user_id, data FROM user_data").fetchall()
+        if not rows and self.legacy_filepath and os.path.exists(self.legacy_filepath):
+            return await self._import_legacy_pickle()
+        user_data = {}
+        for user_id, raw in rows:
+            try:
+                user_data[user_id] = decode_user_data(raw)
+            except orjson.JSONDecodeError as exc:
+                raise RuntimeError(f"❌ Stored data for user {user_id} in {self.filepath} is not valid JSON") from exc
+        return user_data
+
+    def _commit(self, batch: dict[int, dict | None]) -> None:
+        """Writes a batch of staged changes in a single transaction."""
+        encoded = self._encode_batch(batch)
+        with self.conn:
+            for user_id, raw in encoded.items():
+                if raw is None:
+                    self.conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                else:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)", (user_id, raw)
+                    )
+
+    async def _write_pending(self) -> None:
+        """Commits staged changes off the event loop until none are left; the only writer to the database."""
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, {}
+                try:
+                    await asyncio.to_thread(self._commit, batch)
+                except sqlite3.Error:
+                    logger.exception(f"❌ Could not write {len(batch)} users; retrying on the next update")
+                    # Anything staged meanwhile is newer than the failed batch and wins.
+                    self._pending = {**batch, **self._pending}
+                    return
+        finally:
+            self._write_task = None
+
+    def _stage(self, user_id: int, data: dict | None) -> None:
+        # PTB calls update_user_data for every dirty user of a persistence cycle at once, so they
+        # all land in _pending before the write task runs and share one transaction.
+        self._pending[user_id] = data
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(user_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(user_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    # Only user_data is stored; the remaining hooks are required by BasePersistence.
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending:
+            # Last attempt for a batch that failed earlier; errors are logged by _write_pending.
+            await self._write_pending()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+# --- Update Processing ---
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different users concurrently, but each user's updates one at a time.
+
+    PTB holds one of the max_concurrent_updates slots while do_process_update runs. An update for a
+    user who is already being served is therefore queued and returns at once; the running call
+    drains that user's queue in its own slot, so a user with a backlog occupies a single slot and
+    max_concurrent_updates bounds the number of users served at the same time.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._queues: dict[int, deque] = {}  # user_id -> updates waiting behind the running one
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        queue = self._queues.get(user.id)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        queue = self._queues[user.id] = deque()
+        try:
+            while coroutine is not None:
+                try:
+                    await coroutine
+                except Exception:
+                    # Queued updates have no caller left to receive the error.
+                    logger.exception(f"❌ Error while processing an update for user {user.id}")
+                coroutine = queue.popleft() if queue else None
+        finally:
+            del self._queues[user.id]
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 # --- Main Application Setup ---
 
 def main() -> None:
     """Starts the bot."""
-    persistence = PicklePersistence(filepath=PERSISTENCE_FILE)
-    app = ApplicationBuilder().token(TOKEN).persistence(persistence).build()
+    load_dotenv()
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("❌ BOT_TOKEN not set in environment")
+    # basicConfig is a no-op if the root logger is already configured.
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    persistence = SqlitePersistence(
+        filepath=PERSISTENCE_FILE,
+        legacy_filepath=LEGACY_PERSISTENCE_FILE,
+        update_interval=PERSISTENCE_INTERVAL,
+    )
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .connection_pool_size(CONNECTION_POOL_SIZE)
+        .pool_timeout(POOL_TIMEOUT)
+        .build()
+    )
     # Add handlers
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('view', view))
     app.add_handler(CommandHandler('export', export))
     app.add_handler(CommandHandler('edit', edit))
-    app.add_handler(CallbackQueryHandler(category_callback, pattern='^cat_'))
+    app.add_handler(CallbackQueryHandler(category_callback, pattern=r'^(c\d+|cat_.+)$'))
     app.add_handler(CallbackQueryHandler(edit_option_callback, pattern='^edit_'))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
     logger.info(f"🚀 Brain Vault Bot v{VERSION} starting...")
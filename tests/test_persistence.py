@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+
+import pytest
+from telegram.ext import PicklePersistence
+
+from main import SqlitePersistence
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def user_data_with_note():
+    return {
+        'notes': {'all': [1], 'work': [1]},
+        'entries': {1: {'id': 1, 'text': 'call bob', 'ts': '2025-01-02 03:04:05 PM', 'cats': {'all', 'work'}}},
+        'next_note_id': 2,
+        'selected_categories': {'work'},
+        'category_order': {42: ['work']},
+    }
+
+
+async def store(path, updates, drops=()):
+    persistence = SqlitePersistence(str(path))
+    await persistence.get_user_data()
+    for user_id, data in updates.items():
+        await persistence.update_user_data(user_id, data)
+    for user_id in drops:
+        await persistence.drop_user_data(user_id)
+    await persistence.flush()
+
+
+async def load(path):
+    persistence = SqlitePersistence(str(path))
+    try:
+        return await persistence.get_user_data()
+    finally:
+        await persistence.flush()
+
+
+def test_round_trip_restores_sets_and_int_keys(tmp_path):
+    db = tmp_path / "vault.sqlite3"
+    run(store(db, {1: user_data_with_note(), 2: {'notes': {'all': []}}}))
+    assert run(load(db)) == {1: user_data_with_note(), 2: {'notes': {'all': []}}}
+
+
+def test_drop_user_data_deletes_row(tmp_path):
+    db = tmp_path / "vault.sqlite3"
+    run(store(db, {1: {'a': 1}, 2: {'b': 2}}))
+    run(store(db, {}, drops=[1]))
+    assert run(load(db)) == {2: {'b': 2}}
+
+
+def test_unserializable_user_does_not_block_others(tmp_path):
+    db = tmp_path / "vault.sqlite3"
+    run(store(db, {1: {'n': 1}}))
+
+    async def scenario():
+        persistence = SqlitePersistence(str(db))
+        await persistence.get_user_data()
+        await persistence.update_user_data(2, {'n': 2})
+        await persistence.update_user_data(3, {'bad': object()})
+        await persistence._write_task
+        await persistence.update_user_data(4, {'n': 4})
+        await persistence.flush()
+
+    run(scenario())
+    assert run(load(db)) == {1: {'n': 1}, 2: {'n': 2}, 4: {'n': 4}}
+
+
+def test_failed_commit_is_retried_without_losing_newer_data(tmp_path):
+    db = tmp_path / "vault.sqlite3"
+
+    async def scenario():
+        persistence = SqlitePersistence(str(db))
+        await persistence.get_user_data()
+        commit = persistence._commit
+        calls = []
+
+        def flaky_commit(batch):
+            calls.append(sorted(batch))
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            commit(batch)
+
+        persistence._commit = flaky_commit
+        await persistence.update_user_data(1, {'v': 'old'})
+        await persistence.update_user_data(2, {'v': 'kept'})
+        await persistence._write_task
+        assert persistence._write_task is None
+        await persistence.update_user_data(1, {'v': 'new'})
+        await persistence.flush()
+        return calls
+
+    assert run(scenario()) == [[1, 2], [1, 2]]
+    assert run(load(db)) == {1: {'v': 'new'}, 2: {'v': 'kept'}}
+
+
+def test_imports_legacy_pickle_once(tmp_path):
+    pkl = tmp_path / "vault.pkl"
+    db = tmp_path / "vault.sqlite3"
+
+    async def write_pickle():
+        legacy = PicklePersistence(filepath=str(pkl))
+        await legacy.update_user_data(7, {'notes': {'all': ['a @ t']}})
+        await legacy.flush()
+
+    async def load_with_legacy():
+        persistence = SqlitePersistence(str(db), legacy_filepath=str(pkl))
+        try:
+            return await persistence.get_user_data()
+        finally:
+            await persistence.flush()
+
+    run(write_pickle())
+    assert run(load_with_legacy()) == {7: {'notes': {'all': ['a @ t']}}}
+    pkl.unlink()
+    assert run(load(db)) == {7: {'notes': {'all': ['a @ t']}}}
+
+
+def test_undecodable_row_fails_loudly(tmp_path):
+    db = tmp_path / "vault.sqlite3"
+    run(store(db, {1: {'n': 1}}))
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute("UPDATE user_data SET data = ? WHERE user_id = 1", (b'\x80\x04not json',))
+    conn.close()
+    with pytest.raises(RuntimeError, match="user 1"):
+        run(load(db))